@@ -1,17 +1,37 @@
 import os
+from dataclasses import dataclass
+from functools import lru_cache
 from dotenv import load_dotenv
 
-load_dotenv()
 
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-GROUP_CHAT_ID = int(os.getenv('GROUP_CHAT_ID'))
-ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
-DB_PATH = os.getenv('DB_PATH', 'kosyaki.db')
+@dataclass(frozen=True, slots=True)
+class Config:
+    BOT_TOKEN: str
+    GROUP_CHAT_ID: int
+    ADMIN_IDS: frozenset[int]
+    DB_PATH: str
 
-# Проверка обязательных переменных
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN не установлен в .env файле")
-if not GROUP_CHAT_ID:
-    raise ValueError("GROUP_CHAT_ID не установлен в .env файле")
-if not ADMIN_IDS:
-    raise ValueError("ADMIN_IDS не установлен в .env файле")
+
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Читает настройки из .env один раз, при первом обращении"""
+    load_dotenv()
+
+    bot_token = os.getenv('BOT_TOKEN')
+    group_chat_id = os.getenv('GROUP_CHAT_ID')
+    admin_ids = frozenset(int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id)
+
+    # Проверка обязательных переменных
+    if not bot_token:
+        raise ValueError("BOT_TOKEN не установлен в .env файле")
+    if not group_chat_id:
+        raise ValueError("GROUP_CHAT_ID не установлен в .env файле")
+    if not admin_ids:
+        raise ValueError("ADMIN_IDS не установлен в .env файле")
+
+    return Config(
+        BOT_TOKEN=bot_token,
+        GROUP_CHAT_ID=int(group_chat_id),
+        ADMIN_IDS=admin_ids,
+        DB_PATH=os.getenv('DB_PATH', 'kosyaki.db'),
+    )
@@ -1,188 +1,652 @@
+import bisect
 import sqlite3
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache, wraps
 import json
-from typing import Optional, List, Dict
+from typing import Any, Iterator, Optional, List, Dict, Tuple
 import logging
 
+logger = logging.getLogger(__name__)
+
+def _adapt_datetime(value: datetime) -> str:
+    """Даты храним как TEXT 'YYYY-MM-DD HH:MM:SS' — удобно для сравнения диапазонов"""
+    return value.isoformat(sep=' ', timespec='seconds')
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+
+_DDL = """
+    -- Таблица пользователей
+    CREATE TABLE IF NOT EXISTS users (
+        name TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
+
+    -- Таблица косяков
+    CREATE TABLE IF NOT EXISTS mistakes (
+        id INTEGER PRIMARY KEY,
+        user TEXT,
+        description TEXT,
+        date TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+        priority INTEGER DEFAULT 1,
+        closed INTEGER DEFAULT 0,
+        FOREIGN KEY (user) REFERENCES users (name)
+    );
+
+    -- Таблица комментариев
+    CREATE TABLE IF NOT EXISTS comments (
+        id INTEGER PRIMARY KEY,
+        mistake_id INTEGER,
+        user_id INTEGER,
+        text TEXT,
+        date TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+        FOREIGN KEY (mistake_id) REFERENCES mistakes (id)
+    );
+
+    -- История изменений косяков
+    CREATE TABLE IF NOT EXISTS mistake_history (
+        id INTEGER PRIMARY KEY,
+        mistake_id INTEGER,
+        action TEXT,
+        old_value TEXT,
+        new_value TEXT,
+        date TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+        FOREIGN KEY (mistake_id) REFERENCES mistakes (id)
+    );
+
+    -- Индексы под основные фильтры и джойны
+    CREATE INDEX IF NOT EXISTS idx_mistakes_user_closed ON mistakes (user, closed);
+    CREATE INDEX IF NOT EXISTS idx_mistakes_date ON mistakes (date);
+    CREATE INDEX IF NOT EXISTS idx_mistakes_closed_date ON mistakes (closed, date);
+    CREATE INDEX IF NOT EXISTS idx_mistakes_priority ON mistakes (priority);
+    CREATE INDEX IF NOT EXISTS idx_comments_mistake_id ON comments (mistake_id);
+    CREATE INDEX IF NOT EXISTS idx_history_mistake_id ON mistake_history (mistake_id);
+
+    -- Обновляем статистику для планировщика запросов
+    ANALYZE;
+"""
+
+# Полнотекстовый индекс по описаниям косяков, синхронизируется триггерами
+_FTS_DDL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS mistakes_fts USING fts5(
+        description,
+        content='mistakes',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS mistakes_fts_insert AFTER INSERT ON mistakes BEGIN
+        INSERT INTO mistakes_fts (rowid, description) VALUES (new.id, new.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS mistakes_fts_delete AFTER DELETE ON mistakes BEGIN
+        INSERT INTO mistakes_fts (mistakes_fts, rowid, description)
+        VALUES ('delete', old.id, old.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS mistakes_fts_update AFTER UPDATE OF description ON mistakes BEGIN
+        INSERT INTO mistakes_fts (mistakes_fts, rowid, description)
+        VALUES ('delete', old.id, old.description);
+        INSERT INTO mistakes_fts (rowid, description) VALUES (new.id, new.description);
+    END;
+"""
+
+_SQL_FTS_EXISTS = "SELECT 1 FROM sqlite_master WHERE name = 'mistakes_fts'"
+
+_SQL_FTS_REBUILD = "INSERT INTO mistakes_fts (mistakes_fts) VALUES ('rebuild')"
+
+_SQL_GET_USERS = "SELECT name FROM users ORDER BY name"
+
+_SQL_ADD_USER = "INSERT INTO users (name) VALUES (?)"
+
+_SQL_USER_HAS_ACTIVE = """
+    SELECT 1 FROM mistakes 
+    WHERE user = ? AND closed = 0
+    LIMIT 1
+"""
+
+_SQL_DELETE_USER = "DELETE FROM users WHERE name = ?"
+
+# Дату проставляет SQLite; в самом запросе, а не только через DEFAULT,
+# чтобы работало и на базах, созданных до появления DEFAULT у колонки
+_SQL_ADD_MISTAKE = """
+    INSERT INTO mistakes (user, description, priority, date)
+    VALUES (?, ?, ?, datetime('now', 'localtime'))
+"""
+
+_SQL_MISTAKE_EXISTS = "SELECT 1 FROM mistakes WHERE id = ? LIMIT 1"
+
+_SQL_CLOSE_MISTAKE = "UPDATE mistakes SET closed = 1 WHERE id = ?"
+
+_SQL_WEEK_MISTAKES = """
+    SELECT m.id, u.name, m.description, m.date, m.closed
+    FROM mistakes m
+    JOIN users u ON m.user = u.name
+    WHERE m.date >= ? AND m.date < ?
+    ORDER BY m.date DESC
+"""
+
+_SQL_MONTH_MISTAKES = """
+    SELECT m.id, u.name, m.description, m.date, m.closed
+    FROM mistakes m
+    JOIN users u ON m.user = u.name
+    WHERE m.date >= ? AND m.date < ?
+"""
+
+_SQL_USERS_STATS = """
+    SELECT 
+        u.name,
+        SUM(CASE WHEN m.closed = 0 THEN 1 ELSE 0 END) as active,
+        SUM(CASE WHEN m.closed = 1 THEN 1 ELSE 0 END) as closed,
+        COUNT(m.id) as total
+    FROM users u
+    LEFT JOIN mistakes m ON u.name = m.user
+    GROUP BY u.name
+    ORDER BY u.name
+"""
+
+_SQL_USER_DETAILED_STATS = """
+    SELECT 
+        strftime('%Y-%m', m.date) as month,
+        COUNT(CASE WHEN m.closed = 0 THEN 1 END) as active_mistakes,
+        COUNT(CASE WHEN m.closed = 1 THEN 1 END) as closed_mistakes,
+        COUNT(m.id) as total_mistakes
+    FROM users u
+    LEFT JOIN mistakes m ON u.name = m.user
+    WHERE u.name = ?
+    GROUP BY strftime('%Y-%m', m.date)
+    ORDER BY month DESC
+"""
+
+_SQL_ADD_COMMENT = """
+    INSERT INTO comments (mistake_id, user_id, text, date)
+    VALUES (?, ?, ?, datetime('now', 'localtime'))
+"""
+
+_SQL_ADD_HISTORY = """
+    INSERT INTO mistake_history 
+    (mistake_id, action, old_value, new_value)
+    VALUES (?, ?, ?, ?)
+"""
+
+_SQL_MISTAKE_STATS = """
+    SELECT 
+        u.name,
+        COUNT(m.id) as total,
+        COALESCE(SUM(CASE WHEN m.closed = 0 THEN 1 ELSE 0 END), 0) as active,
+        COALESCE(SUM(CASE WHEN m.closed = 1 THEN 1 ELSE 0 END), 0) as closed
+    FROM users u
+    LEFT JOIN mistakes m ON m.user = u.name
+    GROUP BY u.name
+    ORDER BY u.name
+"""
+
+_SQL_PRIORITY_STATS = """
+    SELECT 
+        CASE 
+            WHEN priority = 1 THEN 'Обычный'
+            WHEN priority = 2 THEN 'Критический'
+        END as priority_name,
+        COUNT(*) as count
+    FROM mistakes
+    GROUP BY priority
+"""
+
+_SQL_STATUS_STATS = """
+    SELECT 
+        COUNT(*) as total,
+        SUM(CASE WHEN closed = 0 THEN 1 ELSE 0 END) as active,
+        SUM(CASE WHEN closed = 1 THEN 1 ELSE 0 END) as closed
+    FROM mistakes
+"""
+
+_SQL_GET_MISTAKE = "SELECT * FROM mistakes WHERE id = ?"
+
+_SQL_MISTAKE_COMMENTS = """
+    SELECT text, date, user_id
+    FROM comments
+    WHERE mistake_id = ?
+    ORDER BY date
+"""
+
+# Комментарии сразу для набора косяков: id передаются одним JSON-массивом,
+# чтобы текст запроса не зависел от их количества
+_SQL_MISTAKES_COMMENTS = """
+    SELECT mistake_id, text, date, user_id
+    FROM comments
+    WHERE mistake_id IN (SELECT value FROM json_each(?))
+    ORDER BY date
+"""
+
+_SQL_OLD_MISTAKES = """
+    SELECT *
+    FROM mistakes
+    WHERE 
+        closed = 0 
+        AND date <= datetime('now', ?)
+    ORDER BY date ASC
+"""
+
+_SQL_USER_STATS = """
+    SELECT 
+        COUNT(*) as total,
+        SUM(CASE WHEN closed = 0 THEN 1 ELSE 0 END) as active,
+        SUM(CASE WHEN closed = 1 THEN 1 ELSE 0 END) as closed,
+        SUM(CASE WHEN priority = 1 THEN 1 ELSE 0 END) as priority_1,
+        SUM(CASE WHEN priority = 2 THEN 1 ELSE 0 END) as priority_2,
+        SUM(CASE WHEN priority = 3 THEN 1 ELSE 0 END) as priority_3
+    FROM mistakes
+    WHERE user = ?
+"""
+
+# Сводка и анти-топ за один запрос: выборка slice строится один раз,
+# результат приходит одной JSON-строкой
+_SQL_SUMMARY_STATS = """
+    WITH slice AS (
+        SELECT user, closed, priority
+        FROM mistakes
+        {where}
+    )
+    SELECT json_object(
+        'total', COUNT(*),
+        'active', COALESCE(SUM(closed = 0), 0),
+        'closed', COALESCE(SUM(closed = 1), 0),
+        'priority_1', COALESCE(SUM(priority = 1), 0),
+        'priority_2', COALESCE(SUM(priority = 2), 0),
+        'priority_3', COALESCE(SUM(priority = 3), 0),
+        'top_users', (
+            SELECT json_group_array(json_array(user, count))
+            FROM (
+                SELECT user, COUNT(*) as count
+                FROM slice
+                GROUP BY user
+                ORDER BY count DESC
+                LIMIT 5
+            )
+        )
+    )
+    FROM slice
+"""
+
+_SQL_PERIOD_STATS = _SQL_SUMMARY_STATS.format(where="WHERE date >= datetime('now', ?)")
+
+_SQL_ALL_STATS = _SQL_SUMMARY_STATS.format(where="")
+
+_SQL_HAS_ANY_DATA = "SELECT COUNT(*) FROM mistakes"
+
+_SQL_MISTAKES_BY_DATE = """
+    SELECT *
+    FROM mistakes
+    WHERE date >= ? AND date < ?
+"""
+
+_SQL_USER_MISTAKES = """
+    SELECT *
+    FROM mistakes
+    WHERE user = ?
+    ORDER BY date DESC
+"""
+
+_SQL_DELETE_COMMENTS = "DELETE FROM comments"
+
+_SQL_DELETE_MISTAKES = "DELETE FROM mistakes"
+
+_SQL_DELETE_HISTORY = "DELETE FROM mistake_history"
+
+
+def _fts_query(text: str) -> str:
+    """Запрос для MATCH: каждое слово ищется по префиксу, слова через AND"""
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in text.split())
+
+
+# Горячие запросы, для которых при старте проверяется, что они идут по индексам.
+# Запросы по сотруднику не проверяются: сотрудников единицы, и полный проход
+# по mistakes для них - законный выбор планировщика
+_PLAN_CHECKS = [
+    ("get_week_mistakes", _SQL_WEEK_MISTAKES, ("2024-01-01", "2024-01-08")),
+    ("get_mistakes_by_date", _SQL_MISTAKES_BY_DATE, ("2024-01-01", "2024-01-02")),
+    ("get_old_mistakes", _SQL_OLD_MISTAKES, ("-7 days",)),
+    ("get_period_stats", _SQL_PERIOD_STATS, ("-7 days",)),
+    ("get_mistake", _SQL_GET_MISTAKE, (0,)),
+    ("get_mistake comments", _SQL_MISTAKE_COMMENTS, (0,)),
+    ("delete_user", _SQL_USER_HAS_ACTIVE, ("",)),
+]
+
+# Полный проход допустим только по маленьким таблицам и промежуточным выборкам
+_PLAN_SCAN_ALLOWED = {"u", "users", "slice", "json_each"}
+
+# На маленькой таблице планировщик вправе выбрать полный проход
+_PLAN_CHECK_MIN_ROWS = 1000
+
+
+@lru_cache(maxsize=32)
+def _search_sql(
+    has_user: bool,
+    has_status: bool,
+    has_priority: bool,
+    has_text: bool,
+    use_fts: bool = False
+) -> str:
+    """Текст запроса search_mistakes для заданного набора фильтров"""
+    conditions = []
+    if has_user:
+        conditions.append("user LIKE ?")
+    if has_status:
+        conditions.append("closed = ?")
+    if has_priority:
+        conditions.append("priority = ?")
+    if has_text and use_fts:
+        conditions.append("id IN (SELECT rowid FROM mistakes_fts WHERE mistakes_fts MATCH ?)")
+    elif has_text:
+        conditions.append("(description LIKE ? OR id = ?)")
+
+    where_clause = " AND ".join(conditions) if conditions else "1"
+    return f"""
+    SELECT *
+    FROM mistakes
+    WHERE {where_clause}
+    ORDER BY date DESC
+    LIMIT 50
+"""
+
+
+def _stat_cached(method):
+    """Кэширует результат метода статистики до следующей записи в базу"""
+    @wraps(method)
+    def wrapper(self, *args):
+        if self._dirty:
+            self.mistakes_cache.clear()
+            self._dirty = False
+        key = (method.__name__,) + args
+        if key in self.mistakes_cache:
+            self.cache_hits += 1
+            return self.mistakes_cache[key]
+        self.cache_misses += 1
+        result = method(self, *args)
+        self.mistakes_cache[key] = result
+        return result
+    return wrapper
+
+
+def _locked(method):
+    """Выполняет метод под общим замком соединения"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Priority(Enum):
     NORMAL = 1  # обычный косяк
     CRITICAL = 2  # критический косяк
 
 class Database:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, debug: bool = False):
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
+        # В режиме отладки полный проход в плане горячего запроса — ошибка
+        self.debug = debug
+        # isolation_level=None — autocommit, границы транзакций задаем сами
+        # через begin()/commit()
+        self.conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256
+        )
         self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA mmap_size=268435456;
+            PRAGMA secure_delete=OFF;
+            PRAGMA busy_timeout=5000;
+        """)
+        # Одно соединение на все потоки, поэтому и транзакция у них одна: чтение
+        # из другого потока посреди batch() увидело бы незафиксированные строки.
+        # Замок берут и записи, и чтения, так что чтение дожидается конца batch()
+        self._write_lock = threading.RLock()
+        # Глубина вложенности batch(): пока > 0, commit() откладывается
+        self._batch_depth = 0
         self.create_tables()
-        # Инициализируем кэш
-        self.mistakes_cache = {}
+        # Инициализируем кэш статистики, сбрасывается при любой записи
+        self.mistakes_cache: Dict[tuple, Any] = {}
+        self._dirty = True
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Отсортированный список сотрудников, None — еще не загружен
+        self._users_cache: Optional[List[str]] = None
+
+    def begin(self):
+        """Открывает явную транзакцию"""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+
+    def commit(self):
+        """Фиксирует открытую транзакцию (внутри batch() ничего не делает)"""
+        if self._batch_depth == 0 and self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+
+    @contextmanager
+    def batch(self):
+        """Объединяет несколько операций записи в одну транзакцию.
+
+        Вложенный batch() работает через SAVEPOINT: при ошибке откатываются
+        только его записи, внешняя транзакция продолжается.
+        """
+        with self._write_lock:
+            depth = self._batch_depth
+            savepoint = f"batch_{depth}"
+            if depth == 0:
+                self.begin()
+            else:
+                self.conn.execute(f"SAVEPOINT {savepoint}")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                # Кэши могли запомнить данные отмененной транзакции
+                self._users_cache = None
+                self._dirty = True
+                if depth:
+                    self.conn.execute(f"ROLLBACK TO {savepoint}")
+                    self.conn.execute(f"RELEASE {savepoint}")
+                elif self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if depth:
+                self.conn.execute(f"RELEASE {savepoint}")
+            else:
+                self.commit()
 
     def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                name TEXT PRIMARY KEY
-            )
-        """)
-        
-        # Таблица косяков
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS mistakes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user TEXT,
-                description TEXT,
-                date TIMESTAMP,
-                priority INTEGER DEFAULT 1,
-                closed INTEGER DEFAULT 0,
-                FOREIGN KEY (user) REFERENCES users (name)
-            )
-        """)
-        
-        # Таблица комментариев
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                mistake_id INTEGER,
-                user_id INTEGER,
-                text TEXT,
-                date TIMESTAMP,
-                FOREIGN KEY (mistake_id) REFERENCES mistakes (id)
-            )
-        """)
-        
-        self.conn.commit()
+        self.conn.executescript(_DDL)
 
+        try:
+            fts_exists = self.conn.execute(_SQL_FTS_EXISTS).fetchone() is not None
+            self.conn.executescript(_FTS_DDL)
+            if not fts_exists:
+                # Индексируем косяки, добавленные до появления FTS-таблицы
+                self.conn.execute(_SQL_FTS_REBUILD)
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning("FTS5 недоступен, поиск по тексту через LIKE: %s", e)
+            self.fts_enabled = False
+
+        self.check_query_plans()
+
+    def check_query_plans(self):
+        """Проверяет через EXPLAIN QUERY PLAN, что горячие запросы используют индексы"""
+        rows = self.conn.execute(_SQL_HAS_ANY_DATA).fetchone()[0]
+        if rows < _PLAN_CHECK_MIN_ROWS:
+            return
+        for name, sql, params in _PLAN_CHECKS:
+            plan = self.conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            for row in plan:
+                detail = row[3]
+                # Проход по индексу (например, ради ORDER BY) полным не считается
+                if not detail.startswith("SCAN ") or " USING " in detail:
+                    continue
+                target = detail.split()[1]
+                if target not in _PLAN_SCAN_ALLOWED and not target.startswith("(subquery"):
+                    logger.warning("Запрос %s выполняется полным проходом: %s", name, detail)
+                    assert not self.debug, f"{name}: {detail}"
+
+    @_locked
     def get_users(self) -> List[str]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT name FROM users ORDER BY name")
-        return [row[0] for row in cursor.fetchall()]
+        if self._users_cache is None:
+            cursor = self.conn.execute(_SQL_GET_USERS)
+            self._users_cache = [row[0] for row in cursor.fetchall()]
+        return list(self._users_cache)
 
+    @_locked
     def add_user(self, name: str) -> bool:
-        cursor = self.conn.cursor()
         try:
-            cursor.execute("INSERT INTO users (name) VALUES (?)", (name,))
-            self.conn.commit()
+            self.conn.execute(_SQL_ADD_USER, (name,))
+            self.commit()
+            self._dirty = True
+            if self._users_cache is not None:
+                bisect.insort(self._users_cache, name)
             return True
         except sqlite3.IntegrityError:
             return False
 
+    @_locked
     def delete_user(self, name: str) -> bool:
-        cursor = self.conn.cursor()
         try:
             # Проверяем есть ли у пользователя активные косяки
-            cursor.execute("""
-                SELECT COUNT(*) FROM mistakes 
-                WHERE user = ? AND closed = 0
-            """, (name,))
-            active_mistakes = cursor.fetchone()[0]
-            
-            if active_mistakes > 0:
+            cursor = self.conn.execute(_SQL_USER_HAS_ACTIVE, (name,))
+            if cursor.fetchone() is not None:
                 return False
             
-            cursor.execute("DELETE FROM users WHERE name = ?", (name,))
-            self.conn.commit()
+            cursor = self.conn.execute(_SQL_DELETE_USER, (name,))
+            self.commit()
+            self._dirty = True
+            if cursor.rowcount > 0 and self._users_cache is not None:
+                self._users_cache.remove(name)
             return cursor.rowcount > 0
         except sqlite3.Error:
             return False
 
+    @_locked
     def add_mistake(self, user: str, description: str, priority: int = 1) -> Optional[int]:
         if priority not in [1, 2]:  # Только обычный (1) или критический (2)
             priority = 1  # По умолчанию обычный
-        cursor = self.conn.cursor()
         try:
-            cursor.execute(
-                "INSERT INTO mistakes (user, description, date, priority) VALUES (?, ?, ?, ?)",
-                (user, description, datetime.now(), priority)
+            cursor = self.conn.execute(
+                _SQL_ADD_MISTAKE,
+                (user, description, priority)
             )
-            self.conn.commit()
+            self.commit()
+            self._dirty = True
             return cursor.lastrowid
         except sqlite3.Error:
             return None
 
+    def add_mistakes_bulk(self, rows: List[Tuple[str, str, int]]) -> List[int]:
+        """Добавляет косяки (user, description, priority) одной транзакцией"""
+        if not rows:
+            return []
+        params = [
+            (user, description, priority if priority in [1, 2] else 1)
+            for user, description, priority in rows
+        ]
+        try:
+            with self.batch():
+                self.conn.executemany(
+                    _SQL_ADD_MISTAKE,
+                    params
+                )
+                # Внутри одной транзакции rowid выдаются подряд
+                last_id = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                # Пока замок batch() не отпущен: иначе чтение из другого потока
+                # успеет отдать закэшированную статистику без новых строк
+                self._dirty = True
+            return list(range(last_id - len(params) + 1, last_id + 1))
+        except sqlite3.Error:
+            return []
+
+    @_locked
     def mistake_exists(self, mistake_id: int) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM mistakes WHERE id = ?", (mistake_id,))
-        return cursor.fetchone()[0] > 0
+        cursor = self.conn.execute(_SQL_MISTAKE_EXISTS, (mistake_id,))
+        return cursor.fetchone() is not None
 
+    @_locked
     def close_mistake(self, mistake_id: int) -> bool:
-        cursor = self.conn.cursor()
         try:
-            cursor.execute(
-                "UPDATE mistakes SET closed = 1 WHERE id = ?",
+            self.conn.execute(
+                _SQL_CLOSE_MISTAKE,
                 (mistake_id,)
             )
-            self.conn.commit()
+            self.commit()
+            self._dirty = True
             return True
         except sqlite3.Error:
             return False
 
+    @_locked
     def get_week_mistakes(self, year: int, week: int) -> list:
-        query = """
-        SELECT m.id, u.name, m.description, m.date, m.closed
-        FROM mistakes m
-        JOIN users u ON m.user = u.name
-        WHERE date(m.date, 'weekday 0', '-7 days') >= date('now', 'weekday 0', '-7 days')
-        AND date(m.date) <= date('now')
-        ORDER BY m.date DESC
-        """
-        return self.cursor.execute(query).fetchall()
+        # Границы недели считаем в Python, чтобы фильтр по m.date шел по индексу
+        start = datetime.fromisocalendar(year, week, 1)
+        end = start + timedelta(days=7)
+        cursor = self.conn.execute(_SQL_WEEK_MISTAKES, (start, end))
+        return cursor.fetchall()
 
+    @_locked
     def get_month_mistakes(self, year, month):
-        self.cursor.execute("""
-            SELECT m.id, u.name, m.description, m.date, m.closed
-            FROM mistakes m
-            JOIN users u ON m.user = u.name
-            WHERE strftime('%Y', m.date) = ? AND strftime('%m', m.date) = ?
-        """, (str(year), str(month).zfill(2)))
-        return self.cursor.fetchall()
+        start = datetime(int(year), int(month), 1)
+        end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        cursor = self.conn.execute(_SQL_MONTH_MISTAKES, (start, end))
+        return cursor.fetchall()
 
     # Новый метод: получить всех пользователей с количеством косяков
+    @_locked
+    @_stat_cached
     def get_users_stats(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                u.name,
-                SUM(CASE WHEN m.closed = 0 THEN 1 ELSE 0 END) as active,
-                SUM(CASE WHEN m.closed = 1 THEN 1 ELSE 0 END) as closed,
-                COUNT(m.id) as total
-            FROM users u
-            LEFT JOIN mistakes m ON u.name = m.user
-            GROUP BY u.name
-            ORDER BY u.name
-        """)
+        cursor = self.conn.execute(_SQL_USERS_STATS)
         return cursor.fetchall()
 
     # Новый метод: детальная статистика пользователя
+    @_locked
     def get_user_detailed_stats(self, user_name):
-        self.cursor.execute("""
-            SELECT 
-                strftime('%Y-%m', m.date) as month,
-                COUNT(CASE WHEN m.closed = 0 THEN 1 END) as active_mistakes,
-                COUNT(CASE WHEN m.closed = 1 THEN 1 END) as closed_mistakes,
-                COUNT(m.id) as total_mistakes
-            FROM users u
-            LEFT JOIN mistakes m ON u.name = m.user
-            WHERE u.name = ?
-            GROUP BY strftime('%Y-%m', m.date)
-            ORDER BY month DESC
-        """, (user_name,))
-        return self.cursor.fetchall()
+        cursor = self.conn.execute(_SQL_USER_DETAILED_STATS, (user_name,))
+        return cursor.fetchall()
 
+    @_locked
     def add_comment(self, mistake_id: int, user_id: int, text: str) -> bool:
-        cursor = self.conn.cursor()
         try:
-            cursor.execute(
-                "INSERT INTO comments (mistake_id, user_id, text, date) VALUES (?, ?, ?, ?)",
-                (mistake_id, user_id, text, datetime.now())
+            self.conn.execute(
+                _SQL_ADD_COMMENT,
+                (mistake_id, user_id, text)
             )
-            self.conn.commit()
+            self.commit()
+            self._dirty = True
+            return True
+        except sqlite3.Error:
+            return False
+
+    def add_comments_bulk(self, rows: List[Tuple[int, int, str]]) -> bool:
+        """Добавляет комментарии (mistake_id, user_id, text) одной транзакцией"""
+        if not rows:
+            return True
+        try:
+            with self.batch():
+                self.conn.executemany(
+                    _SQL_ADD_COMMENT,
+                    rows
+                )
+                self._dirty = True
             return True
         except sqlite3.Error:
             return False
 
+    @_locked
     def add_history(
         self,
         mistake_id: int,
@@ -190,106 +654,68 @@ class Database:
         old_value: Optional[str],
         new_value: Optional[str]
     ) -> None:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """
-            INSERT INTO mistake_history 
-            (mistake_id, action, old_value, new_value)
-            VALUES (?, ?, ?, ?)
-            """,
+        self.conn.execute(
+            _SQL_ADD_HISTORY,
             (mistake_id, action, old_value, new_value)
         )
-        self.conn.commit()
+        self.commit()
 
-    def search_mistakes(self, **params) -> List[Dict]:
+    @_locked
+    def search_mistakes(self, **params) -> Iterator[sqlite3.Row]:
         """
         Поиск косяков по параметрам:
         - user: имя сотрудника
         - status: 'open' или 'closed'
         - priority: 1, 2 или 3
         - text: текст для поиска в описании
+
+        Возвращает итератор по sqlite3.Row (не больше 50 строк)
         """
-        conditions = []
         query_params = []
         
         if 'user' in params:
-            conditions.append("user LIKE ?")
             query_params.append(f"%{params['user']}%")
         
         if 'status' in params:
-            conditions.append("closed = ?")
             query_params.append(1 if params['status'] == 'closed' else 0)
         
         if 'priority' in params:
-            conditions.append("priority = ?")
             query_params.append(params['priority'])
         
+        use_fts = False
         if 'text' in params:
-            conditions.append("(description LIKE ? OR id = ?)")
-            query_params.extend([f"%{params['text']}%", 
-                               params['text'] if params['text'].isdigit() else -1])
-        
-        where_clause = " AND ".join(conditions) if conditions else "1"
-        
-        cursor = self.conn.cursor()
-        cursor.execute(f"""
-            SELECT *
-            FROM mistakes
-            WHERE {where_clause}
-            ORDER BY date DESC
-            LIMIT 50
-        """, query_params)
+            text = params['text']
+            fts_query = _fts_query(text)
+            # Номер косяка ищем по id, остальное — через полнотекстовый индекс
+            use_fts = self.fts_enabled and bool(fts_query) and not text.isdigit()
+            if use_fts:
+                query_params.append(fts_query)
+            else:
+                query_params.extend([f"%{text}%", text if text.isdigit() else -1])
         
-        return [dict(row) for row in cursor.fetchall()]
+        sql = _search_sql(
+            'user' in params, 'status' in params, 'priority' in params, 'text' in params,
+            use_fts
+        )
+        cursor = self.conn.execute(sql, query_params)
+        # LIMIT 50 — забираем все строки за один вызов fetchmany
+        cursor.arraysize = 50
+        return iter(cursor.fetchmany())
 
+    @_locked
+    @_stat_cached
     def get_mistake_stats(self) -> Dict[str, Dict[str, int]]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                m.user,
-                COUNT(*) as total,
-                SUM(CASE WHEN m.closed = 0 THEN 1 ELSE 0 END) as active,
-                SUM(CASE WHEN m.closed = 1 THEN 1 ELSE 0 END) as closed
-            FROM mistakes m
-            GROUP BY m.user
-            ORDER BY m.user
-        """)
-        
-        stats = {}
-        rows = cursor.fetchall()
-        for row in rows:
-            if row[0]:  # Проверяем, что имя пользователя не None
-                stats[row[0]] = {
-                    'total': row[1] or 0,
-                    'active': row[2] or 0,
-                    'closed': row[3] or 0
-                }
-                
-        # Добавляем пользователей без косяков
-        cursor.execute("SELECT name FROM users")
-        users = [row[0] for row in cursor.fetchall()]
-        for user in users:
-            if user not in stats:
-                stats[user] = {
-                    'total': 0,
-                    'active': 0,
-                    'closed': 0
-                }
-                
-        return stats
+        # LEFT JOIN от users сразу дает нули для сотрудников без косяков
+        cursor = self.conn.execute(_SQL_MISTAKE_STATS)
+        return {
+            row[0]: {'total': row[1], 'active': row[2], 'closed': row[3]}
+            for row in cursor.fetchall()
+        }
 
+    @_locked
+    @_stat_cached
     def get_priority_stats(self) -> Dict[str, int]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                CASE 
-                    WHEN priority = 1 THEN 'Обычный'
-                    WHEN priority = 2 THEN 'Критический'
-                END as priority_name,
-                COUNT(*) as count
-            FROM mistakes
-            GROUP BY priority
-        """)
+        cursor = self.conn.execute(_SQL_PRIORITY_STATS)
         
         stats = {'Обычный': 0, 'Критический': 0}
         for row in cursor.fetchall():
@@ -297,15 +723,10 @@ class Database:
                 stats[row[0]] = row[1]
         return stats
 
+    @_locked
+    @_stat_cached
     def get_status_stats(self) -> Dict[str, int]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN closed = 0 THEN 1 ELSE 0 END) as active,
-                SUM(CASE WHEN closed = 1 THEN 1 ELSE 0 END) as closed
-            FROM mistakes
-        """)
+        cursor = self.conn.execute(_SQL_STATUS_STATS)
         
         row = cursor.fetchone()
         return {
@@ -315,67 +736,19 @@ class Database:
         }
 
     def get_mistake_details(self, mistake_id: int) -> Optional[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                m.*,
-                GROUP_CONCAT(c.text, '|') as comments,
-                GROUP_CONCAT(c.date, '|') as comment_dates,
-                GROUP_CONCAT(c.user_id, '|') as comment_users
-            FROM mistakes m
-            LEFT JOIN comments c ON m.id = c.mistake_id
-            WHERE m.id = ?
-            GROUP BY m.id
-        """, (mistake_id,))
-        row = cursor.fetchone()
-        if not row:
-            return None
-        
-        result = dict(row)
-        
-        # Преобразуем комментарии в список
-        if result['comments']:
-            comments = []
-            texts = result['comments'].split('|')
-            dates = result['comment_dates'].split('|')
-            users = result['comment_users'].split('|')
-            for text, date, user in zip(texts, dates, users):
-                comments.append({
-                    'text': text,
-                    'date': date,
-                    'user_id': int(user)
-                })
-            result['comments'] = comments
-        else:
-            result['comments'] = []
-        
-        return result
+        return self.get_mistake(mistake_id)
 
-    def get_old_mistakes(self, days: int = 7) -> List[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT *
-            FROM mistakes
-            WHERE 
-                closed = 0 
-                AND date <= datetime('now', ?)
-            ORDER BY date ASC
-        """, (f'-{days} days',))
-        return [dict(row) for row in cursor.fetchall()]
+    @_locked
+    def get_old_mistakes(self, days: int = 7) -> Iterator[sqlite3.Row]:
+        # Строки читаются целиком под замком: курсор на общем соединении,
+        # дочитанный после его снятия, увидел бы чужую открытую транзакцию
+        cursor = self.conn.execute(_SQL_OLD_MISTAKES, (f'-{days} days',))
+        return iter(cursor.fetchall())
 
+    @_locked
+    @_stat_cached
     def get_user_stats(self, user: str) -> Dict:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN closed = 0 THEN 1 ELSE 0 END) as active,
-                SUM(CASE WHEN closed = 1 THEN 1 ELSE 0 END) as closed,
-                SUM(CASE WHEN priority = 1 THEN 1 ELSE 0 END) as priority_1,
-                SUM(CASE WHEN priority = 2 THEN 1 ELSE 0 END) as priority_2,
-                SUM(CASE WHEN priority = 3 THEN 1 ELSE 0 END) as priority_3
-            FROM mistakes
-            WHERE user = ?
-        """, (user,))
+        cursor = self.conn.execute(_SQL_USER_STATS, (user,))
         
         result = cursor.fetchone()
         return {
@@ -387,130 +760,109 @@ class Database:
             'priority_3': result[5] or 0
         }
 
+    @_locked
     def get_period_stats(self, days: int) -> Dict:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN closed = 0 THEN 1 ELSE 0 END) as active,
-                SUM(CASE WHEN closed = 1 THEN 1 ELSE 0 END) as closed,
-                SUM(CASE WHEN priority = 1 THEN 1 ELSE 0 END) as priority_1,
-                SUM(CASE WHEN priority = 2 THEN 1 ELSE 0 END) as priority_2,
-                SUM(CASE WHEN priority = 3 THEN 1 ELSE 0 END) as priority_3
-            FROM mistakes
-            WHERE date >= datetime('now', ?)
-        """, (f'-{days} days',))
-        
-        result = cursor.fetchone()
-        stats = {
-            'total': result[0] or 0,
-            'active': result[1] or 0,
-            'closed': result[2] or 0,
-            'priority_1': result[3] or 0,
-            'priority_2': result[4] or 0,
-            'priority_3': result[5] or 0
-        }
-        
-        # Добавляем топ пользователей
-        cursor.execute("""
-            SELECT user, COUNT(*) as count
-            FROM mistakes
-            WHERE date >= datetime('now', ?)
-            GROUP BY user
-            ORDER BY count DESC
-            LIMIT 5
-        """, (f'-{days} days',))
-        
-        stats['top_users'] = cursor.fetchall()
-        return stats
+        return self._summary_stats(_SQL_PERIOD_STATS, (f'-{days} days',))
 
+    @_locked
+    @_stat_cached
     def get_all_stats(self) -> Dict:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN closed = 0 THEN 1 ELSE 0 END) as active,
-                SUM(CASE WHEN closed = 1 THEN 1 ELSE 0 END) as closed,
-                SUM(CASE WHEN priority = 1 THEN 1 ELSE 0 END) as priority_1,
-                SUM(CASE WHEN priority = 2 THEN 1 ELSE 0 END) as priority_2,
-                SUM(CASE WHEN priority = 3 THEN 1 ELSE 0 END) as priority_3
-            FROM mistakes
-        """)
-        
-        result = cursor.fetchone()
-        stats = {
-            'total': result[0] or 0,
-            'active': result[1] or 0,
-            'closed': result[2] or 0,
-            'priority_1': result[3] or 0,
-            'priority_2': result[4] or 0,
-            'priority_3': result[5] or 0
-        }
-        
-        # Добавляем топ пользователей
-        cursor.execute("""
-            SELECT user, COUNT(*) as count
-            FROM mistakes
-            GROUP BY user
-            ORDER BY count DESC
-            LIMIT 5
-        """)
-        
-        stats['top_users'] = cursor.fetchall()
+        return self._summary_stats(_SQL_ALL_STATS, ())
+
+    def _summary_stats(self, sql: str, params: tuple) -> Dict:
+        cursor = self.conn.execute(sql, params)
+        stats = json.loads(cursor.fetchone()[0])
+        stats['top_users'] = [tuple(row) for row in stats['top_users']]
         return stats
 
+    @_locked
     def has_any_data(self) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM mistakes")
+        cursor = self.conn.execute(_SQL_HAS_ANY_DATA)
         return cursor.fetchone()[0] > 0
 
-    def __del__(self):
+    @_locked
+    def backup(self, path: str) -> None:
+        """Копирует базу в файл через online backup API SQLite"""
+        target = sqlite3.connect(path)
+        try:
+            self.conn.backup(target)
+        finally:
+            target.close()
+
+    @_locked
+    def close(self):
+        """Закрывает соединение, сохраняя статистику для планировщика"""
+        try:
+            self.conn.execute("PRAGMA optimize")
+        except sqlite3.ProgrammingError:
+            # Соединение уже закрыто
+            return
         self.conn.close()
 
+    def __del__(self):
+        self.close()
+
+    @_locked
     def get_mistake(self, mistake_id: int) -> Optional[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT m.*, GROUP_CONCAT(c.text) as comments
-            FROM mistakes m
-            LEFT JOIN comments c ON m.id = c.mistake_id
-            WHERE m.id = ?
-            GROUP BY m.id
-        """, (mistake_id,))
+        cursor = self.conn.execute(_SQL_GET_MISTAKE, (mistake_id,))
         row = cursor.fetchone()
-        return dict(row) if row else None
+        if not row:
+            return None
+
+        result = dict(row)
+        cursor = self.conn.execute(_SQL_MISTAKE_COMMENTS, (mistake_id,))
+        result['comments'] = [dict(c) for c in cursor.fetchall()]
+        return result
 
+    @_locked
     def get_mistakes_by_date(self, date_str: str) -> List[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT m.*, GROUP_CONCAT(c.text) as comments
-            FROM mistakes m
-            LEFT JOIN comments c ON m.id = c.mistake_id
-            WHERE DATE(m.date) = DATE(?)
-            GROUP BY m.id
-        """, (date_str,))
-        return [dict(row) for row in cursor.fetchall()]
+        start = datetime.fromisoformat(date_str).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        end = start + timedelta(days=1)
+        cursor = self.conn.execute(_SQL_MISTAKES_BY_DATE, (start, end))
+        return self._with_comments([dict(row) for row in cursor.fetchall()])
 
+    @_locked
     def get_user_mistakes(self, user: str) -> List[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT m.*, GROUP_CONCAT(c.text) as comments
-            FROM mistakes m
-            LEFT JOIN comments c ON m.id = c.mistake_id
-            WHERE m.user = ?
-            GROUP BY m.id
-            ORDER BY m.date DESC
-        """, (user,))
-        return [dict(row) for row in cursor.fetchall()]
+        cursor = self.conn.execute(_SQL_USER_MISTAKES, (user,))
+        return self._with_comments([dict(row) for row in cursor.fetchall()])
+
+    def _with_comments(self, mistakes: List[Dict]) -> List[Dict]:
+        """Подгружает комментарии для списка косяков одним запросом"""
+        by_id = {m['id']: m for m in mistakes}
+        for m in mistakes:
+            m['comments'] = []
+        if not by_id:
+            return mistakes
+
+        cursor = self.conn.execute(_SQL_MISTAKES_COMMENTS, (json.dumps(list(by_id)),))
+        for row in cursor.fetchall():
+            by_id[row['mistake_id']]['comments'].append({
+                'text': row['text'],
+                'date': row['date'],
+                'user_id': row['user_id']
+            })
+        return mistakes
 
+    @_locked
     def clear_mistakes(self) -> bool:
-        """Очищает все косяки и комментарии, сохраняя таблицу пользователей"""
-        cursor = self.conn.cursor()
+        """Очищает все косяки, комментарии и историю, сохраняя таблицу пользователей"""
         try:
-            # Очищаем комментарии
-            cursor.execute("DELETE FROM comments")
-            # Очищаем косяки
-            cursor.execute("DELETE FROM mistakes")
-            self.conn.commit()
+            # Все DELETE в одной транзакции; DELETE без WHERE при
+            # secure_delete=OFF SQLite выполняет без обхода по строкам
+            # (для mistakes этому мешают FTS-триггеры)
+            with self.batch():
+                # Очищаем комментарии
+                self.conn.execute(_SQL_DELETE_COMMENTS)
+                # История тоже: id косяков после очистки начинаются заново
+                self.conn.execute(_SQL_DELETE_HISTORY)
+                # Очищаем косяки
+                self.conn.execute(_SQL_DELETE_MISTAKES)
+            self._dirty = True
+            if not self.conn.in_transaction:
+                # Возвращаем место, занятое WAL после массового удаления
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
             return True
         except sqlite3.Error:
             return False
\ No newline at end of file
@@ -1,7 +1,7 @@
 import os
 import re
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Iterable, Iterator
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import (
     Message, 
@@ -18,13 +18,15 @@ from database import Database, Priority
 from io import BytesIO
 import pandas as pd
 from enum import Enum
-from cachetools import TTLCache
+from cachetools import TTLCache, cached
 import logging
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import asyncio
+import functools
+import threading
 import sqlite3
-from config import BOT_TOKEN, GROUP_CHAT_ID, ADMIN_IDS, DB_PATH
+from config import get_config
 
 # Настройка логирования
 logging.basicConfig(
@@ -41,10 +43,22 @@ logger = logging.getLogger(__name__)
 os.makedirs('logs', exist_ok=True)
 os.makedirs('backup', exist_ok=True)
 
+# Настройки из .env
+config = get_config()
+_ADMIN_IDS = frozenset(config.ADMIN_IDS)
+
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=config.BOT_TOKEN)
 dp = Dispatcher()
 
+# Единственный планировщик на процесс. Пропущенные запуски схлопываются в
+# один, и задача не запускается повторно, пока не завершилась предыдущая
+scheduler = AsyncIOScheduler(job_defaults={
+    'coalesce': True,
+    'max_instances': 1,
+    'misfire_grace_time': 30,
+})
+
 # Роутеры
 admin_router = Router(name='admin_router')
 group_router = Router(name='group_router')
@@ -54,7 +68,7 @@ dp.include_router(admin_router)
 dp.include_router(group_router)
 
 # Инициализация базы данных
-db = Database(DB_PATH)
+db = Database(config.DB_PATH)
 
 # Определяем клавиатуру админа
 admin_kb = ReplyKeyboardMarkup(
@@ -71,41 +85,215 @@ admin_kb = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+# Inline-клавиатуры меню не меняются, собираем их один раз
+_STATS_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="По сотрудникам", callback_data="stats_type:users")],
+        [InlineKeyboardButton(text="По приоритетам", callback_data="stats_type:priority")],
+        [InlineKeyboardButton(text="По статусам", callback_data="stats_type:status")]
+    ]
+)
+
+_REPORTS_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="За неделю", callback_data="report:week")],
+        [InlineKeyboardButton(text="За месяц", callback_data="report:month")],
+        [InlineKeyboardButton(text="За все время", callback_data="report:all")]
+    ]
+)
+
+_SEARCH_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="По сотруднику", callback_data="search:by_user")],
+        [InlineKeyboardButton(text="По номеру косяка", callback_data="search:by_id")],
+        [InlineKeyboardButton(text="По дате", callback_data="search:by_date")]
+    ]
+)
+
+_CLEAR_CONFIRM_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Да, очистить", callback_data="clear_stats:confirm"),
+            InlineKeyboardButton(text="❌ Отмена", callback_data="clear_stats:cancel")
+        ]
+    ]
+)
+
+# Тексты кнопок действий над косяком
+_BTN_CLOSE = "✅ Закрыть"
+_BTN_COMMENT = "💬 Комментировать"
+_BTN_HISTORY = "📝 История"
+_BTN_PRIORITY = "⭐ Изменить приоритет"
+
+# Шаблоны команд группового чата
+# Группа 1 — маркер критического косяка "!!!"
+_RE_ADD = re.compile(r'\+1 косяк\s+(!!!\s+)?([А-Яа-я]+\s+[А-Яа-я]+)\s*-\s*(.+)')
+_RE_CLOSE = re.compile(r'-1 косяк\s+#(\d+)(?:\s*-\s*(.+))?')
+_GROUP_COMMANDS = ('+1 косяк', '-1 косяк')
+
 # Проверка на админа с отладкой
 def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    return user_id in _ADMIN_IDS
 
 def format_mistakes(mistakes, title=""):
     if not mistakes:
         return f"{title}Косяков нет"
-    response = f"{title}\n"
+    parts = [title, "\n"]
+    append = parts.append
     for m_id, user, desc, date, closed in mistakes:
-        status = "✅" if closed else "❌"
-        response += f"#{m_id} {user} - {desc} ({date}) {status}\n"
-    return response
+        append(f"#{m_id} {user} - {desc} ({date}) {'✅' if closed else '❌'}\n")
+    return "".join(parts)
 
 def format_users_stats(stats):
     if not stats:
         return "Сотрудников нет"
-    response = "Список сотрудников:\n"
+    parts = ["Список сотрудников:\n"]
+    append = parts.append
     for name, active, closed, total in stats:
-        response += f"{name}: Активных: {active or 0}, Закрытых: {closed or 0}, Всего: {total or 0}\n"
-    return response
+        append(f"{name}: Активных: {active or 0}, Закрытых: {closed or 0}, Всего: {total or 0}\n")
+    return "".join(parts)
 
 def format_user_detailed_stats(stats, user_name):
     if not stats:
         return f"Статистика для {user_name}: косяков нет"
-    response = f"Статистика для {user_name}:\n"
+    parts = [f"Статистика для {user_name}:\n"]
+    append = parts.append
     for month, active, closed, total in stats:
-        response += f"{month}: Активных: {active or 0}, Исправленных: {closed or 0}, Всего: {total or 0}\n"
-    return response
+        append(f"{month}: Активных: {active or 0}, Исправленных: {closed or 0}, Всего: {total or 0}\n")
+    return "".join(parts)
 
 async def admin_filter(message: Message) -> bool:
     return is_admin(message.from_user.id)
 
+def admin_only(handler):
+    """Пропускает в хендлер только админов, остальным в callback - алерт"""
+    @functools.wraps(handler)
+    async def wrapper(event, *args, **kwargs):
+        if event.from_user.id not in _ADMIN_IDS:
+            if isinstance(event, CallbackQuery):
+                await event.answer("У вас нет доступа к этой функции", show_alert=True)
+            return
+        return await handler(event, *args, **kwargs)
+    return wrapper
+
+def command_args(text: str) -> str:
+    """Текст после команды; отделяться от нее он может и переводом строки"""
+    parts = text.split(None, 1)
+    return parts[1] if len(parts) > 1 else ""
+
+async def _db(fn, *args, **kwargs):
+    """Выполняет синхронный метод базы в отдельном потоке, не блокируя event loop"""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
 # Кэш для частых запросов
+# Ключи: id косяка и ('user', имя) для списка косяков сотрудника
 mistakes_cache = TTLCache(maxsize=100, ttl=300)  # Кэш на 5 минут
 users_cache = TTLCache(maxsize=100, ttl=600)     # Кэш на 10 минут
+_stats_cache = TTLCache(maxsize=64, ttl=30)       # Кэш отчетов на 30 секунд
+
+# users_cache хранит список ('all'), множество ('set') и готовый текст ('txt').
+# Заполняется из потоков _db(), читается и из event loop, поэтому под замком
+_users_lock = threading.RLock()
+
+@cached(users_cache, key=lambda: 'all', lock=_users_lock)
+def _get_users() -> tuple:
+    """Имена сотрудников в алфавитном порядке"""
+    return tuple(db.get_users())
+
+@cached(users_cache, key=lambda: 'set', lock=_users_lock)
+def _get_users_set() -> frozenset:
+    """Множество имен сотрудников для быстрой проверки `user in users`"""
+    return frozenset(_get_users())
+
+@cached(users_cache, key=lambda: 'txt', lock=_users_lock)
+def _get_users_text() -> str:
+    """Markdown списка сотрудников, пустая строка - сотрудников нет"""
+    users = _get_users()
+    if not users:
+        return ""
+    return "*Список сотрудников:*\n\n" + "".join(f"👤 {user}\n" for user in users)
+
+async def _users_cached(key: str, fn):
+    """Попадание в кэш отдается сразу, в поток уходит только промах"""
+    with _users_lock:
+        value = users_cache.get(key)
+    if value is None:
+        value = await _db(fn)
+    return value
+
+def invalidate_users():
+    with _users_lock:
+        users_cache.clear()
+
+async def get_users_cached() -> frozenset:
+    return await _users_cached('set', _get_users_set)
+
+async def get_users_list() -> tuple:
+    return await _users_cached('all', _get_users)
+
+# Подтверждения в группу копятся по чатам и раз в полсекунды уходят одним
+# сообщением: при наплыве косяков не упираемся в лимит сообщений на чат.
+# Блокировка не нужна: между await в event loop словарь меняет только один код
+_REPLY_FLUSH_INTERVAL = 0.5
+_pending_replies: Dict[int, List[str]] = {}
+_reply_flusher: Optional[asyncio.Task] = None
+# Флаг остановки: фоновая задача дописывает текущую пачку и выходит сама,
+# отмена посреди send_message потеряла бы уже снятые с очереди подтверждения
+_reply_stop: Optional[asyncio.Event] = None
+
+def enqueue_reply(chat_id: int, line: str) -> None:
+    _pending_replies.setdefault(chat_id, []).append(line)
+
+async def _send_pending_replies():
+    global _pending_replies
+    if not _pending_replies:
+        return
+    pending, _pending_replies = _pending_replies, {}
+    for chat_id, lines in pending.items():
+        # Пачка подтверждений может не влезть в одно сообщение
+        for chunk in chunk_text(line + "\n" for line in lines):
+            try:
+                await bot.send_message(chat_id, chunk)
+            except Exception as e:
+                logger.error("Error sending batched replies: %s", e)
+
+async def _flush_replies_forever():
+    while True:
+        try:
+            await asyncio.wait_for(_reply_stop.wait(), _REPLY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            await _send_pending_replies()
+        else:
+            return
+
+async def get_mistake_cached(mistake_id: int) -> Optional[Dict]:
+    mistake = mistakes_cache.get(mistake_id)
+    if mistake is None:
+        mistake = await _db(db.get_mistake, mistake_id)
+        if mistake is not None:
+            mistakes_cache[mistake_id] = mistake
+    return mistake
+
+async def get_user_mistakes_cached(user: str) -> List[Dict]:
+    key = ('user', user)
+    mistakes = mistakes_cache.get(key)
+    if mistakes is None:
+        mistakes = await _db(db.get_user_mistakes, user)
+        mistakes_cache[key] = mistakes
+    return mistakes
+
+def invalidate_mistake(mistake_id: int, user: str):
+    """Сбрасывает кэш косяка и списка косяков его сотрудника"""
+    mistakes_cache.pop(mistake_id, None)
+    mistakes_cache.pop(('user', user), None)
+
+async def _cached_stats(key: tuple, fn, *args):
+    """Результат агрегирующего запроса из кэша, при промахе - из базы"""
+    stats = _stats_cache.get(key)
+    if stats is None:
+        stats = await _db(fn, *args)
+        _stats_cache[key] = stats
+    return stats
 
 # Функции для админ-панели (личные сообщения с ботом)
 async def cmd_start(message: Message):
@@ -119,47 +307,44 @@ async def cmd_start(message: Message):
         reply_markup=admin_kb
     )
 
+@admin_only
 async def cmd_add_user(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
-    args = message.text.split()[1:]
-    if len(args) < 2:
+    user_name = " ".join(command_args(message.text).split())
+    if ' ' not in user_name:
         await message.reply(
             "Используйте формат:\n"
             "/add_user Имя Фамилия"
         )
         return
         
-    user_name = " ".join(args)
-    if db.add_user(user_name):
+    if await _db(db.add_user, user_name):
+        invalidate_users()
+        _stats_cache.clear()
         await message.reply(f"Сотрудник {user_name} добавлен")
     else:
         await message.reply(f"Сотрудник {user_name} уже существует")
 
+@admin_only
 async def cmd_del_user(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
     try:
-        args = message.text.split()[1:]
-        if len(args) < 2:
+        user_name = " ".join(command_args(message.text).split())
+        if ' ' not in user_name:
             await message.reply(
                 "Используйте формат:\n"
                 "/del_user Имя Фамилия"
             )
             return
-            
-        user_name = " ".join(args)
         
         # Проверяем существует ли пользователь
-        users = db.get_users()
-        if user_name not in users:
+        if user_name not in await get_users_cached():
             await message.reply(f"❌ Сотрудник {user_name} не найден")
             return
         
         # Пробуем удалить пользователя
-        if db.delete_user(user_name):
+        if await _db(db.delete_user, user_name):
+            invalidate_users()
+            mistakes_cache.pop(('user', user_name), None)
+            _stats_cache.clear()
             await message.reply(f"✅ Сотрудник {user_name} удален")
         else:
             await message.reply(
@@ -169,38 +354,33 @@ async def cmd_del_user(message: Message):
     except Exception as e:
         await handle_db_error(message, e)
 
+@admin_only
 async def find_mistake(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
     try:
-        mistake_id = int(message.text.split()[1])
-        mistake = db.get_mistake(mistake_id)
+        mistake_id = int(command_args(message.text))
+        mistake = await get_mistake_cached(mistake_id)
         if mistake:
             await message.reply(format_mistake_details(mistake))
         else:
             await message.reply(f"❌ Косяк #{mistake_id} не найден")
-    except (IndexError, ValueError):
+    except ValueError:
         await message.reply(
             "❌ Неверный формат. Используйте:\n"
             "/find_mistake ID"
         )
 
+@admin_only
 async def find_by_date(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
     try:
-        date_str = message.text.split()[1]
-        mistakes = db.get_mistakes_by_date(date_str)
+        date_str = command_args(message.text).strip()
+        mistakes = await _db(db.get_mistakes_by_date, date_str)
         if mistakes:
-            response = f"Найдено косяков за {date_str}:\n\n"
-            for mistake in mistakes:
-                response += format_mistake_details(mistake) + "\n"
-            await message.reply(response)
+            parts = [f"Найдено косяков за {date_str}:\n\n"]
+            parts.extend(format_mistake_details(mistake) + "\n" for mistake in mistakes)
+            await send_chunked(message.reply, parts)
         else:
             await message.reply(f"За {date_str} косяков не найдено")
-    except (IndexError, ValueError):
+    except ValueError:
         await message.reply(
             "❌ Неверный формат. Используйте:\n"
             "/find_date YYYY-MM-DD"
@@ -212,21 +392,21 @@ def get_mistake_inline_keyboard(mistake_id: int) -> InlineKeyboardMarkup:
         inline_keyboard=[
             [
                 InlineKeyboardButton(
-                    text="✅ Закрыть",
+                    text=_BTN_CLOSE,
                     callback_data=f"close_mistake:{mistake_id}"
                 ),
                 InlineKeyboardButton(
-                    text="💬 Комментировать",
+                    text=_BTN_COMMENT,
                     callback_data=f"comment_mistake:{mistake_id}"
                 )
             ],
             [
                 InlineKeyboardButton(
-                    text="📝 История",
+                    text=_BTN_HISTORY,
                     callback_data=f"mistake_history:{mistake_id}"
                 ),
                 InlineKeyboardButton(
-                    text="⭐ Изменить приоритет",
+                    text=_BTN_PRIORITY,
                     callback_data=f"change_priority:{mistake_id}"
                 )
             ]
@@ -237,9 +417,58 @@ async def safe_reply(message: Message, text: str, **kwargs) -> Optional[Message]
     try:
         return await message.reply(text, **kwargs)
     except Exception as e:
-        print(f"Error sending message: {e}")
+        logger.error("Error sending message: %s", e)
         return None
 
+# Telegram режет сообщения длиннее 4096 символов, считая их в единицах UTF-16
+# (эмодзи вроде 👤 занимают две), берем с запасом
+_MESSAGE_LIMIT = 4000
+# Пауза между частями одного длинного ответа, чтобы не упереться в лимит чата
+_CHUNK_DELAY = 1
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+def _cut_utf16(text: str, limit: int) -> tuple:
+    """Делит текст на первые limit единиц UTF-16 и остаток"""
+    data = text.encode('utf-16-le')
+    cut = limit * 2
+    # Не разрываем суррогатную пару
+    if 0xD800 <= int.from_bytes(data[cut - 2:cut], 'little') <= 0xDBFF:
+        cut -= 2
+    return data[:cut].decode('utf-16-le'), data[cut:].decode('utf-16-le')
+
+def chunk_text(parts: Iterable[str], limit: int = _MESSAGE_LIMIT) -> Iterator[str]:
+    """Склеивает части в куски не длиннее limit, не разрывая части без нужды"""
+    buf = []
+    size = 0
+    for part in parts:
+        length = _utf16_len(part)
+        # Одна часть длиннее лимита режется на куски сама
+        while length > limit:
+            if size:
+                yield "".join(buf)
+                buf.clear()
+                size = 0
+            head, part = _cut_utf16(part, limit)
+            yield head
+            length = _utf16_len(part)
+        if size + length > limit:
+            yield "".join(buf)
+            buf.clear()
+            size = 0
+        buf.append(part)
+        size += length
+    if size:
+        yield "".join(buf)
+
+async def send_chunked(send, parts: Iterable[str]):
+    """Отправляет длинный ответ несколькими сообщениями через send(text)"""
+    for i, chunk in enumerate(chunk_text(parts)):
+        if i:
+            await asyncio.sleep(_CHUNK_DELAY)
+        await send(chunk)
+
 def format_mistake_markdown(mistake) -> str:
     priority_marks = "❗" * mistake['priority']
     status = "✅" if mistake['closed'] else "❌"
@@ -266,19 +495,20 @@ def format_status_stats(stats) -> str:
     if not stats:
         return "*Статистика по статусам:*\nДанных нет"
         
-    response = "*Статистика по статусам:*\n\n"
+    parts = ["*Статистика по статусам:*\n\n"]
+    append = parts.append
     for month, active, closed in stats:
         total = active + closed
         if total == 0:
             continue
         percent_closed = (closed / total) * 100
-        response += (
+        append(
             f"*{month}*\n"
             f"📊 Всего: `{total}`\n"
             f"❌ Активных: `{active}`\n"
             f"✅ Закрытых: `{closed}` ({percent_closed:.1f}%)\n\n"
         )
-    return response
+    return "".join(parts)
 
 def format_mistake_details(mistake: Dict) -> str:
     status = "✅ Закрыт" if mistake['closed'] else "❌ Активен"
@@ -292,21 +522,35 @@ def format_mistake_details(mistake: Dict) -> str:
         f"📊 Статус: {status}"
     )
     if mistake['comments']:
-        result += f"\n💬 Комментарии: {mistake['comments']}"
+        comments = ", ".join(c['text'] for c in mistake['comments'])
+        result += f"\n💬 Комментарии: {comments}"
     return result
 
+# Подсказки для поиска, не требующие запроса к базе
+_SEARCH_HINTS = {
+    "by_id": (
+        "Для поиска косяка по номеру используйте команду:\n"
+        "/find_mistake <номер>\n\n"
+        "Например: /find_mistake 123"
+    ),
+    "by_date": (
+        "Для поиска косяков по дате используйте команду:\n"
+        "/find_date YYYY-MM-DD\n\n"
+        "Например: /find_date 2024-02-25"
+    ),
+}
+
+@admin_only
 async def process_search_callback(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У вас нет доступа к этой функции", show_alert=True)
-        return
-
-    search_type = callback.data.split(':')[1]
+    _, _, search_type = callback.data.partition(':')
     
     if search_type == "by_user":
-        users = db.get_users()
+        users = await get_users_list()
         if not users:
-            await callback.message.answer("В базе пока нет сотрудников")
-            await callback.answer()
+            await asyncio.gather(
+                callback.message.answer("В базе пока нет сотрудников"),
+                callback.answer()
+            )
             return
             
         keyboard = InlineKeyboardMarkup(
@@ -315,175 +559,188 @@ async def process_search_callback(callback: CallbackQuery):
                 for user in users
             ]
         )
-        await callback.message.answer("Выберите сотрудника:", reply_markup=keyboard)
-        
-    elif search_type == "by_id":
-        await callback.message.answer(
-            "Для поиска косяка по номеру используйте команду:\n"
-            "/find_mistake <номер>\n\n"
-            "Например: /find_mistake 123"
-        )
-        
-    elif search_type == "by_date":
-        await callback.message.answer(
-            "Для поиска косяков по дате используйте команду:\n"
-            "/find_date YYYY-MM-DD\n\n"
-            "Например: /find_date 2024-02-25"
+        await asyncio.gather(
+            callback.message.answer("Выберите сотрудника:", reply_markup=keyboard),
+            callback.answer()
         )
+        return
 
-    await callback.answer()
+    hint = _SEARCH_HINTS.get(search_type)
+    if hint:
+        await asyncio.gather(callback.message.answer(hint), callback.answer())
+    else:
+        await callback.answer()
 
+@admin_only
 async def process_show_user_callback(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У вас нет доступа к этой функции", show_alert=True)
-        return
-
-    user = callback.data.split(':')[1]
-    mistakes = db.get_user_mistakes(user)
+    _, _, user = callback.data.partition(':')
+    mistakes = await get_user_mistakes_cached(user)
     
     if not mistakes:
-        await callback.message.answer(f"У сотрудника {user} нет косяков")
-        await callback.answer()
+        await asyncio.gather(
+            callback.message.answer(f"У сотрудника {user} нет косяков"),
+            callback.answer()
+        )
         return
         
-    response = f"Косяки сотрудника {user}:\n\n"
-    for mistake in mistakes:
-        response += format_mistake_details(mistake) + "\n"
+    parts = [f"Косяки сотрудника {user}:\n\n"]
+    parts.extend(format_mistake_details(mistake) + "\n" for mistake in mistakes)
     
-    await callback.message.answer(response)
-    await callback.answer()
+    await asyncio.gather(
+        send_chunked(callback.message.answer, parts),
+        callback.answer()
+    )
+
+async def _stats_users() -> str:
+    stats = await _cached_stats(('users',), db.get_users_stats)
+    if not stats:
+        return "*Статистика по сотрудникам:*\nНет данных"
+
+    parts = ["*Статистика по сотрудникам:*\n\n"]
+    append = parts.append
+    for user, active, closed, total in stats:
+        append(
+            f"*{user}*:\n"
+            f"Всего косяков: `{total or 0}`\n"
+            f"Активных: `{active or 0}`\n"
+            f"Закрытых: `{closed or 0}`\n\n"
+        )
+    return "".join(parts)
+
+async def _stats_priority() -> str:
+    stats = await _cached_stats(('priority',), db.get_priority_stats)
+    return (
+        "*Статистика по приоритетам:*\n\n"
+        f"❗ Обычные: `{stats['Обычный']}`\n"
+        f"‼️ Критические: `{stats['Критический']}`\n"
+    )
+
+async def _stats_status() -> str:
+    stats = await _cached_stats(('status',), db.get_status_stats)
+    return (
+        "*Статистика по статусам:*\n\n"
+        f"Активных: `{stats['active']}`\n"
+        f"Закрытых: `{stats['closed']}`\n"
+        f"Всего: `{stats['total']}`\n"
+    )
+
+_STATS_DISPATCH = {
+    "users": _stats_users,
+    "priority": _stats_priority,
+    "status": _stats_status,
+}
 
+@admin_only
 async def process_stats_type(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У вас нет доступа к этой функции", show_alert=True)
+    _, _, stats_type = callback.data.partition(':')
+    handler = _STATS_DISPATCH.get(stats_type)
+    if handler is None:
+        await callback.answer()
         return
 
-    stats_type = callback.data.split(':')[1]
-    
-    if stats_type == "users":
-        stats = db.get_users_stats()
-        if not stats:
-            await callback.message.edit_text(
-                "*Статистика по сотрудникам:*\nНет данных",
-                parse_mode="Markdown"
-            )
-            await callback.answer()
-            return
-            
-        response = "*Статистика по сотрудникам:*\n\n"
-        for user, active, closed, total in stats:
-            response += f"*{user}*:\n"
-            response += f"Всего косяков: `{total or 0}`\n"
-            response += f"Активных: `{active or 0}`\n"
-            response += f"Закрытых: `{closed or 0}`\n\n"
-    
-    elif stats_type == "priority":
-        stats = db.get_priority_stats()
-        response = "*Статистика по приоритетам:*\n\n"
-        response += f"❗ Обычные: `{stats['Обычный']}`\n"
-        response += f"‼️ Критические: `{stats['Критический']}`\n"
-    
-    elif stats_type == "status":
-        stats = db.get_status_stats()
-        response = "*Статистика по статусам:*\n\n"
-        response += f"Активных: `{stats['active']}`\n"
-        response += f"Закрытых: `{stats['closed']}`\n"
-        response += f"Всего: `{stats['total']}`\n"
-
-    await callback.message.edit_text(
-        response,
-        parse_mode="Markdown"
+    response = await handler()
+    await asyncio.gather(
+        callback.message.edit_text(response, parse_mode="Markdown"),
+        callback.answer()
     )
-    await callback.answer()
 
+_MEDALS = ("🥇", "🥈", "🥉")
+
+# Период отчета: (дней, заголовок); неизвестный период - отчет за все время
+_REPORT_PERIODS = {
+    'week': (7, "за неделю"),
+    'month': (30, "за месяц"),
+}
+
+@admin_only
 async def process_report(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У вас нет доступа к этой функции", show_alert=True)
-        return
-        
-    period = callback.data.split(':')[1]
+    _, _, period = callback.data.partition(':')
+    days, title = _REPORT_PERIODS.get(period, (None, "за все время"))
     
-    if period == 'week':
-        days = 7
-        title = "за неделю"
-    elif period == 'month':
-        days = 30
-        title = "за месяц"
+    if days:
+        stats = await _cached_stats(('period', days), db.get_period_stats, days)
     else:
-        days = None
-        title = "за все время"
-    
-    stats = db.get_period_stats(days) if days else db.get_all_stats()
+        stats = await _cached_stats(('all',), db.get_all_stats)
     
-    response = f"*Отчет {title}:*\n\n"
-    response += f"Всего косяков: `{stats['total']}`\n"
-    response += f"Активных: `{stats['active']}`\n"
-    response += f"Закрытых: `{stats['closed']}`\n\n"
-    
-    response += "*По приоритетам:*\n"
-    response += f"❗ Обычные: `{stats['priority_1']}`\n"
-    response += f"‼️ Критические: `{stats['priority_2']}`\n"
-    
-    response += "*Анти-топ сотрудников:*\n"
-    for i, (user, count) in enumerate(stats['top_users'], 1):
-        medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else "👎"
-        response += f"{medal} {user}: `{count}` косяков\n"
+    parts = [
+        f"*Отчет {title}:*\n\n"
+        f"Всего косяков: `{stats['total']}`\n"
+        f"Активных: `{stats['active']}`\n"
+        f"Закрытых: `{stats['closed']}`\n\n"
+        "*По приоритетам:*\n"
+        f"❗ Обычные: `{stats['priority_1']}`\n"
+        f"‼️ Критические: `{stats['priority_2']}`\n"
+        "*Анти-топ сотрудников:*\n"
+    ]
+    parts.extend(
+        f"{_MEDALS[i] if i < 3 else '👎'} {user}: `{count}` косяков\n"
+        for i, (user, count) in enumerate(stats['top_users'])
+    )
     
-    await callback.message.edit_text(
-        response,
-        parse_mode="Markdown"
+    await asyncio.gather(
+        callback.message.edit_text("".join(parts), parse_mode="Markdown"),
+        callback.answer()
     )
-    await callback.answer()
 
+@admin_only
 async def cmd_clear_stats(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
     # Запрашиваем подтверждение
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="✅ Да, очистить", callback_data="clear_stats:confirm"),
-                InlineKeyboardButton(text="❌ Отмена", callback_data="clear_stats:cancel")
-            ]
-        ]
-    )
-    
     await message.reply(
         "⚠️ Вы уверены, что хотите очистить всю статистику косяков?\n"
         "Это действие нельзя отменить!\n"
         "Список сотрудников останется без изменений.",
-        reply_markup=keyboard
+        reply_markup=_CLEAR_CONFIRM_KB
     )
 
 @admin_router.callback_query(F.data.startswith('clear_stats:'))
+@admin_only
 async def process_clear_stats(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У вас нет доступа к этой функции", show_alert=True)
-        return
-
-    action = callback.data.split(':')[1]
+    _, _, action = callback.data.partition(':')
     
     if action == "confirm":
-        if db.clear_mistakes():
-            await callback.message.edit_text("✅ Статистика косяков очищена")
+        if await _db(db.clear_mistakes):
+            _stats_cache.clear()
+            mistakes_cache.clear()
+            text = "✅ Статистика косяков очищена"
         else:
-            await callback.message.edit_text("❌ Произошла ошибка при очистке статистики")
+            text = "❌ Произошла ошибка при очистке статистики"
     else:
-        await callback.message.edit_text("❌ Очистка статистики отменена")
+        text = "❌ Очистка статистики отменена"
     
-    await callback.answer()
+    await asyncio.gather(callback.message.edit_text(text), callback.answer())
+
+async def backup_database():
+    """Ночная копия базы в папку backup"""
+    path = os.path.join('backup', f"kosyaki_{datetime.now():%Y-%m-%d}.db")
+    try:
+        await _db(db.backup, path)
+        logger.info("Database backup saved: %s", path)
+    except Exception as e:
+        logger.error("Database backup failed: %s", e)
 
 async def on_startup():
     """Действия при запуске бота"""
+    global _reply_flusher, _reply_stop
     logger.info("Bot starting...")
+    scheduler.add_job(backup_database, CronTrigger(hour=3), id='backup', replace_existing=True)
+    scheduler.start()
+    _reply_stop = asyncio.Event()
+    _reply_flusher = asyncio.create_task(_flush_replies_forever())
+    start_group_worker()
     logger.info("Bot started successfully")
 
 async def on_shutdown():
     """Действия при остановке бота"""
     logger.info("Bot stopping...")
+    scheduler.shutdown(wait=False)
+    # Воркер может добавить подтверждения, поэтому очередь ответов сбрасывается после него
+    await stop_group_worker()
+    if _reply_flusher is not None:
+        _reply_stop.set()
+        await _reply_flusher
+        await _send_pending_replies()
     await bot.session.close()
-    db.conn.close()
+    db.close()
     logger.info("Bot stopped successfully")
 
 async def main():
@@ -509,100 +766,104 @@ async def main():
     admin_router.callback_query.register(process_clear_stats, F.data.startswith('clear_stats:'))
     
     # Регистрируем хендлер для группового чата
-    group_router.message.register(group_handler, F.chat.id == GROUP_CHAT_ID)
+    group_router.message.register(group_handler, F.chat.id == config.GROUP_CHAT_ID)
+    
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     
     # Запускаем бота
     try:
         await dp.start_polling(bot)
     except Exception as e:
-        logger.error(f"Error while polling: {e}")
+        logger.error("Error while polling: %s", e)
 
 # Функции-обработчики для меню
+@admin_only
 async def show_users_menu(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-    
-    users = db.get_users()
-    if not users:
+    response = await _users_cached('txt', _get_users_text)
+    if not response:
         await message.reply(
             "📝 В базе данных пока нет сотрудников.\n\n"
             "Добавить сотрудника: /add_user Имя Фамилия"
         )
         return
     
-    response = "*Список сотрудников:*\n\n"
-    for user in users:
-        response += f"👤 {user}\n"
-    
     await message.reply(response, parse_mode="Markdown")
 
+@admin_only
 async def show_statistics_menu(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="По сотрудникам", callback_data="stats_type:users")],
-            [InlineKeyboardButton(text="По приоритетам", callback_data="stats_type:priority")],
-            [InlineKeyboardButton(text="По статусам", callback_data="stats_type:status")]
-        ]
-    )
-    
-    await message.reply("📊 Выберите тип статистики:", reply_markup=keyboard)
+    await message.reply("📊 Выберите тип статистики:", reply_markup=_STATS_KB)
 
+@admin_only
 async def show_reports_menu(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-        
-    if not db.has_any_data():
+    if not await _db(db.has_any_data):
         await message.reply("📑 Отчеты пока недоступны - нет данных")
         return
         
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="За неделю", callback_data="report:week")],
-            [InlineKeyboardButton(text="За месяц", callback_data="report:month")],
-            [InlineKeyboardButton(text="За все время", callback_data="report:all")]
-        ]
-    )
-    
-    await message.reply("📑 Выберите период для отчета:", reply_markup=keyboard)
+    await message.reply("📑 Выберите период для отчета:", reply_markup=_REPORTS_KB)
 
+@admin_only
 async def show_search_menu(message: Message):
-    if not is_admin(message.from_user.id):
+    await message.reply("🔍 Выберите тип поиска:", reply_markup=_SEARCH_KB)
+
+# Бот обслуживает один групповой чат (GROUP_CHAT_ID), поэтому его команды
+# разбирает один воркер по очереди: порядок +1/-1 сохраняется, а хендлер
+# aiogram не ждет записи в базу
+_group_queue: Optional[asyncio.Queue] = None
+_group_worker_task: Optional[asyncio.Task] = None
+# Сколько при остановке ждать, пока воркер разберет очередь
+_GROUP_DRAIN_TIMEOUT = 10
+
+async def _group_worker(queue: asyncio.Queue):
+    while True:
+        message = await queue.get()
+        try:
+            await process_group_message(message)
+        except Exception as e:
+            logger.error("Error handling group message: %s", e)
+        finally:
+            queue.task_done()
+
+def start_group_worker():
+    global _group_queue, _group_worker_task
+    _group_queue = asyncio.Queue()
+    _group_worker_task = asyncio.create_task(_group_worker(_group_queue))
+
+async def stop_group_worker():
+    """Дожидается обработки уже принятых команд и останавливает воркер"""
+    global _group_worker_task
+    if _group_worker_task is None:
         return
-        
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="По сотруднику", callback_data="search:by_user")],
-            [InlineKeyboardButton(text="По номеру косяка", callback_data="search:by_id")],
-            [InlineKeyboardButton(text="По дате", callback_data="search:by_date")]
-        ]
-    )
-    
-    await message.reply("🔍 Выберите тип поиска:", reply_markup=keyboard)
+    try:
+        await asyncio.wait_for(_group_queue.join(), _GROUP_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Group queue not drained in %s s, %d messages dropped",
+            _GROUP_DRAIN_TIMEOUT, _group_queue.qsize()
+        )
+    _group_worker_task.cancel()
+    await asyncio.gather(_group_worker_task, return_exceptions=True)
+    _group_worker_task = None
 
 # Обработчик группового чата
 async def group_handler(message: Message):
-    if not message.text:
+    # Обычная переписка в группе отсекается до проверки админа и логирования
+    text = message.text
+    if not text or not text.lstrip().startswith(_GROUP_COMMANDS):
         return
-        
+
     if not is_admin(message.from_user.id):
         return
 
+    await _group_queue.put(message)
+
+async def process_group_message(message: Message):
     text = message.text.strip()
-    logger.info(f"Group message received: {text}")
+    logger.debug("Group message received: %s", text)
     
     # Добавление косяка
     if text.startswith('+1 косяк'):
-        # Проверяем критический ли это косяк
-        if '!!!' in text:
-            match = re.match(r'\+1 косяк\s+!!!\s+([А-Яа-я]+\s+[А-Яа-я]+)\s*-\s*(.+)', text)
-            priority = 2  # Критический
-        else:
-            match = re.match(r'\+1 косяк\s+([А-Яа-я]+\s+[А-Яа-я]+)\s*-\s*(.+)', text)
-            priority = 1  # Обычный
-            
+        match = _RE_ADD.match(text)
         if not match:
             await message.reply(
                 "❌ Неверный формат. Используйте:\n"
@@ -611,33 +872,34 @@ async def group_handler(message: Message):
             )
             return
             
-        user = match.group(1)
-        desc = match.group(2)
+        user = match.group(2)
+        desc = match.group(3)
+        # Критический (2), если указан "!!!", иначе обычный (1)
+        priority = 2 if match.group(1) else 1
         
-        if user not in db.get_users():
-            users = db.get_users()
+        if user not in await get_users_cached():
+            users = await get_users_list()
             await message.reply(
                 f"❌ Сотрудник {user} не найден.\n"
                 f"Доступные сотрудники:\n" + "\n".join(f"• {u}" for u in users)
             )
             return
             
-        mistake_id = db.add_mistake(user, desc, priority)
+        mistake_id = await _db(db.add_mistake, user, desc, priority)
         if mistake_id:
-            priority_text = "критический" if priority == 2 else "обычный"
+            _stats_cache.clear()
+            mistakes_cache.pop(('user', user), None)
             priority_emoji = "‼️" if priority == 2 else "❗"
-            await message.reply(
-                f"{priority_emoji} Косяк #{mistake_id} добавлен\n"
-                f"Сотрудник: {user}\n"
-                f"Приоритет: {priority_text}\n"
-                f"Описание: {desc}"
+            enqueue_reply(
+                message.chat.id,
+                f"{priority_emoji} Косяк #{mistake_id} добавлен: {user} - {desc}"
             )
         else:
             await message.reply("❌ Ошибка при добавлении косяка")
     
     # Закрытие косяка
     elif text.startswith('-1 косяк'):
-        match = re.match(r'-1 косяк\s+#(\d+)(?:\s*-\s*(.+))?', text)
+        match = _RE_CLOSE.match(text)
         if not match:
             await message.reply(
                 "❌ Неверный формат. Используйте:\n"
@@ -650,22 +912,25 @@ async def group_handler(message: Message):
         mistake_id = int(match.group(1))
         comment = match.group(2)
         
-        if not db.mistake_exists(mistake_id):
+        # Заодно узнаем сотрудника, чтобы сбросить его список в кэше
+        mistake = await get_mistake_cached(mistake_id)
+        if not mistake:
             await message.reply(f"❌ Косяк #{mistake_id} не найден")
             return
             
-        if db.close_mistake(mistake_id):
+        if await _db(db.close_mistake, mistake_id):
+            _stats_cache.clear()
             response = f"✅ Косяк #{mistake_id} закрыт"
             if comment:
-                db.add_comment(mistake_id, message.from_user.id, comment)
-                response += f"\nКомментарий: {comment}"
-            await message.reply(response)
+                await _db(db.add_comment, mistake_id, message.from_user.id, comment)
+                response += f" - {comment}"
+            invalidate_mistake(mistake_id, mistake['user'])
+            enqueue_reply(message.chat.id, response)
         else:
             await message.reply(f"❌ Ошибка при закрытии косяка #{mistake_id}")
 
 async def handle_db_error(message: Message, error: Exception):
-    error_msg = f"Ошибка базы данных: {str(error)}"
-    logger.error(error_msg)
+    logger.error("Ошибка базы данных: %s", error)
     await message.reply(
         "❌ Произошла ошибка при работе с базой данных.\n"
         "Пожалуйста, попробуйте позже."
@@ -677,4 +942,4 @@ if __name__ == "__main__":
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped by user")
     except Exception as e:
-        logger.error(f"Bot crashed: {e}")
\ No newline at end of file
+        logger.error("Bot crashed: %s", e)
\ No newline at end of file